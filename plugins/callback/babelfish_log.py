@@ -26,6 +26,14 @@ DOCUMENTATION = '''
         ini:
           - section: callback_babelfish_log
             key: log_folder
+      aggregate_log:
+        default: no
+        description: Whether to write all hosts to a single ansible.log in the log folder, prefixing each record with host=<name>.
+        env:
+          - name: ANSIBLE_LOG_AGGREGATE
+        ini:
+          - section: callback_babelfish_log
+            key: aggregate_log
       format_invocation:
         default: no
         description: Whether or not to format the invocation dictionary./
@@ -50,6 +58,14 @@ DOCUMENTATION = '''
         ini:
           - section: callback_babelfish_log
             key: backup_count
+      write_buffer_size:
+        default: 65536
+        description: Number of bytes buffered per log file before they are written out, 0 writes every record immediately.
+        env:
+          - name: ANSIBLE_LOG_WRITE_BUFFER_SIZE
+        ini:
+          - section: callback_babelfish_log
+            key: write_buffer_size
       time_format:
         default: "%b %d %Y %H:%M:%S"
         description: Time format string.
@@ -85,23 +101,34 @@ DOCUMENTATION = '''
 '''
 
 import os
+import re
+import atexit
 import time
+import threading
 import json
 import logging
 import copy
-from logging.handlers import RotatingFileHandler
+from logging.handlers import MemoryHandler, RotatingFileHandler
 from logging import ERROR, INFO, WARNING
 
-from ansible.utils.path import makedirs_safe
-from ansible.module_utils.common._collections_compat import MutableMapping
+from ansible.module_utils.common._collections_compat import Mapping, MutableMapping
 from ansible.plugins.callback import CallbackBase
 
 DEFAULT_FOLDER = '/var/log/ansible/hosts'
 DEFAULT_TIME_FORMAT = '%b %d %Y %H:%M:%S'
+DEFAULT_WRITE_BUFFER_SIZE = 65536
+# Number of records held in memory before they are handed to the file handler
+MEMORY_CAPACITY = 512
+AGGREGATE_LOG_FILE = 'ansible.log'
+AGGREGATE_MSG_PREFIX = 'host=%(host)s - '
 DEFAULT_MSG_FORMAT = '%(now)s - %(playbook)s - %(task_name)s - %(task_action)s - %(category)s - %(data)s\n\n'
 
+# Fields available to msg_format
+MSG_FIELDS = ('now', 'host', 'playbook', 'task_name', 'task_action', 'category', 'data')
+MSG_TOKEN = re.compile(r'%\((\w+)\)s|%%')
+
 # Fields to reformat output for
-FIELDS = [
+FIELDS = (
     'cmd',
     'command',
     'start',
@@ -112,9 +139,213 @@ FIELDS = [
     'stdout',
     'stderr',
     'results',
-    'item',
     '_ansible_item_label'
-]
+)
+
+# Shared encoder for payloads rendered into log records
+JSON_ENCODER = json.JSONEncoder(indent=2, sort_keys=True, default=str)
+# Single-line encoder for unformatted invocation arguments
+COMPACT_JSON_ENCODER = json.JSONEncoder(default=str)
+# Stands in for the payload when a record is split around it for streaming
+PAYLOAD_MARKER = '\x00payload\x00'
+
+
+def encode_payload(payload, encoder=JSON_ENCODER):
+    """
+    Serialize a restructured result to a string, falling back to its str()
+    form when it can't be encoded as JSON.
+    """
+    try:
+        return encoder.encode(payload)
+    except (TypeError, ValueError, RecursionError):
+        return to_text(payload)
+
+
+def to_text(obj):
+    """
+    str() of obj, or a placeholder when obj is nested too deeply for even
+    that to be rendered.
+    """
+    try:
+        return str(obj)
+    except RecursionError:
+        return '<%s nested too deeply to log>' % type(obj).__name__
+
+
+def compile_msg_format(msg_format):
+    """
+    Compile a %-style message format into a function taking MSG_FIELDS as
+    keyword arguments, so the format is parsed once instead of per record.
+    Formats using anything other than %(field)s and %% fall back to the
+    % operator.
+    """
+    def fallback(**fields):
+        return msg_format % fields
+
+    parts = []
+    position = 0
+    for match in MSG_TOKEN.finditer(msg_format):
+        literal = msg_format[position:match.start()]
+        field = match.group(1)
+        if '%' in literal or (field is not None and field not in MSG_FIELDS):
+            return fallback
+        if field is None:
+            literal += '%'
+        if literal:
+            parts.append(repr(literal))
+        if field is not None:
+            parts.append('str(%s)' % field)
+        position = match.end()
+
+    literal = msg_format[position:]
+    if '%' in literal:
+        return fallback
+    if literal:
+        parts.append(repr(literal))
+
+    source = 'def build(%s):\n    return %s\n' % (', '.join(MSG_FIELDS), ' + '.join(parts) or "''")
+    namespace = {}
+    exec(compile(source, '<msg_format>', 'exec'), namespace)
+    return namespace['build']
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotating file handler that hands records to the kernel in batches of
+    ``buffer_size`` bytes rather than issuing a write per record.
+    """
+
+    def __init__(self, filename, buffer_size=DEFAULT_WRITE_BUFFER_SIZE, **kwargs):
+        self.buffer_size = buffer_size
+        self.position = 0
+        super(BatchedRotatingFileHandler, self).__init__(filename, **kwargs)
+
+    def _open(self):
+        stream = open(self.baseFilename,
+                      self.mode,
+                      buffering=self.buffer_size or -1,
+                      encoding=self.encoding,
+                      errors=self.errors)
+        # Track the file size ourselves, tell() would flush the write buffer
+        self.position = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def _prepare_write(self, text):
+        """
+        Open the stream and roll it over if text won't fit. Returns the
+        number of bytes text takes up once encoded, maxBytes counts bytes
+        rather than characters.
+        """
+        if self.stream is None:
+            self.stream = self._open()
+        if self.maxBytes <= 0:
+            return 0
+        size = len(text.encode(self.stream.encoding, self.stream.errors))
+        if self.position and self.position + size >= self.maxBytes:
+            self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+        return size
+
+    def write(self, text, size):
+        self.stream.write(text)
+        self.position += size
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+            self.write(msg, self._prepare_write(msg))
+            # Failures bypass the batch so they show up straight away
+            if not self.buffer_size or record.levelno >= ERROR:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class DirectFileLogger(object):
+    """
+    Append-only stand-in for a host logger, used when no rotation is
+    configured. Records skip the logging machinery, are encoded into a
+    pending buffer and handed to os.write() in batches of ``buffer_size``
+    bytes. Structured payloads are encoded into the buffer chunk by chunk as
+    the JSON encoder produces them, without building the whole string first.
+    """
+
+    level = INFO
+    terminator = '\n'
+
+    def __init__(self, filename, buffer_size=DEFAULT_WRITE_BUFFER_SIZE):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.fd = None
+        self.pending = bytearray()
+        # Results can arrive on the strategy's results thread as well as the main one
+        self.lock = threading.RLock()
+        atexit.register(self.close)
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def log(self, level, msg):
+        if level < self.level:
+            return
+
+        # Encode the whole record before it joins the batch, so a failure
+        # can never leave part of it in front of the next one
+        record = (msg + self.terminator).encode('utf-8', 'backslashreplace')
+        with self.lock:
+            self.pending += record
+            self._flush_if_due(level)
+
+    def log_payload(self, level, head, payload, tail=''):
+        """
+        Log head, payload serialized as JSON and tail as a single record.
+        Payloads that can't be encoded as JSON are logged in their str() form.
+        """
+        if level < self.level:
+            return
+
+        with self.lock:
+            mark = len(self.pending)
+            try:
+                self.pending += head.encode('utf-8', 'backslashreplace')
+                for chunk in JSON_ENCODER.iterencode(payload):
+                    self.pending += chunk.encode('utf-8', 'backslashreplace')
+            except (TypeError, ValueError, RecursionError):
+                # Take back the half-encoded record before logging it as text
+                del self.pending[mark:]
+                self.pending += (head + to_text(payload)).encode('utf-8', 'backslashreplace')
+            self.pending += (tail + self.terminator).encode('utf-8', 'backslashreplace')
+            self._flush_if_due(level)
+
+    def _flush_if_due(self, level):
+        # Failures bypass the batch so they show up straight away
+        if not self.buffer_size or level >= ERROR or len(self.pending) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            if self.fd is None:
+                self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            written = 0
+            try:
+                with memoryview(self.pending) as view:
+                    while written < len(view):
+                        with view[written:] as chunk:
+                            written += os.write(self.fd, chunk)
+            finally:
+                # Drop what reached the file even if a later write failed,
+                # so it isn't written a second time on the next flush
+                del self.pending[:written]
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
 
 
 class CallbackModule(CallbackBase):
@@ -130,18 +361,24 @@ class CallbackModule(CallbackBase):
     msg_format = DEFAULT_MSG_FORMAT
 
     log_folder = DEFAULT_FOLDER
+    aggregate_log = False
     format_invocation = False
     respect_no_log = True
     max_bytes = 0
     backup_count = 0
-    whitelist_keys = []
+    write_buffer_size = DEFAULT_WRITE_BUFFER_SIZE
+    whitelist_keys = frozenset()
 
-    loggers = {}
     play_timestamp = ''
+    _ts_cached_sec = -1
+    _ts_cached_str = ''
     playbook = None
 
     def __init__(self):
         super(CallbackModule, self).__init__()
+        self.loggers = {}
+        self.aggregate_logger = None
+        self._msg_builder = compile_msg_format(self.msg_format)
 
     def set_options(self,
                     task_keys=None,
@@ -152,12 +389,14 @@ class CallbackModule(CallbackBase):
             var_options=var_options,
             direct=direct
         )
+        previous = self._logger_settings()
         self.log_folder = self.get_option('log_folder') \
             if 'log_folder' in self._plugin_options \
             else DEFAULT_FOLDER
         self.time_format = self.get_option('time_format') \
             if 'time_format' in self._plugin_options \
             else DEFAULT_TIME_FORMAT
+        self._ts_cached_sec = -1
         self.msg_format = self.get_option('msg_format') \
             if 'msg_format' in self._plugin_options \
             else DEFAULT_MSG_FORMAT
@@ -168,106 +407,199 @@ class CallbackModule(CallbackBase):
         self.backup_count = int(self.get_option('backup_count')
                                 if 'backup_count' in self._plugin_options
                                 else 0)
+        self.write_buffer_size = int(self.get_option('write_buffer_size')
+                                     if 'write_buffer_size' in self._plugin_options
+                                     else DEFAULT_WRITE_BUFFER_SIZE)
 
         self.format_invocation = (self.get_option('format_invocation')
                                   if 'format_invocation' in self._plugin_options
                                   else 'no').lower() == 'yes'
 
-        self.whitelist_keys = (self.get_option('whitelist_dict_keys')
-                               if 'whitelist_dict_keys' in self._plugin_options
-                               else '').split(',')
-
-        if not os.path.exists(self.log_folder):
-            makedirs_safe(self.log_folder)
-
-    def filter_dict_keys(self, node, keys=None):
-        if not keys:
-            return node
+        self.aggregate_log = (self.get_option('aggregate_log')
+                              if 'aggregate_log' in self._plugin_options
+                              else 'no').lower() == 'yes'
+        if self.aggregate_log:
+            self.msg_format = AGGREGATE_MSG_PREFIX + self.msg_format
+        self._msg_builder = compile_msg_format(self.msg_format)
+
+        self.whitelist_keys = frozenset(
+            key.strip()
+            for key
+            in (self.get_option('whitelist_dict_keys')
+                if 'whitelist_dict_keys' in self._plugin_options
+                else '').split(',')
+            if key.strip()
+        )
 
-        if not isinstance(keys, list) and isinstance(keys, str):
-            keys = [keys]
-        else:
-            return None
+        os.makedirs(self.log_folder, exist_ok=True)
 
-        if isinstance(node, dict):
-            return_value = {}
-            for key in node:
-                if key in keys:
-                    return_value[key] = copy.deepcopy(node[key])
-                elif isinstance(node[key], list) or isinstance(node[key], dict):
-                    child = self.filter_dict_keys(node[key], keys)
-                    if child:
-                        return_value[key] = child
-            if return_value:
-                return return_value
-            else:
-                return None
-        elif isinstance(node, list):
-            return_value = []
+        if self._logger_settings() != previous:
+            self._reset_loggers()
 
-            if not return_value:
-                return_value = []
-            for entry in node:
-                child = self.filter_dict_keys(entry, keys)
-                if child:
-                    return_value.append(child)
+    def _logger_settings(self):
+        return (self.log_folder,
+                self.aggregate_log,
+                self.max_bytes,
+                self.backup_count,
+                self.write_buffer_size)
 
+    def _reset_loggers(self):
+        # Loggers created under the old settings write to the wrong place,
+        # hand over what they hold before letting them go
+        self._flush_loggers()
+        for logger in set(logger for logger, _ in self.loggers.values()):
+            if isinstance(logger, DirectFileLogger):
+                logger.close()
+        self.loggers = {}
+        self.aggregate_logger = None
 
     def _get_logger(self, host):
-        logger_dir = os.path.join(self.log_folder, host)
-        if not os.path.exists(logger_dir):
-            makedirs_safe(logger_dir)
-        logger = logging.getLogger('babelfish_log_%s' % host)
-        logger.setLevel(INFO)
-        logger.addHandler(
-            RotatingFileHandler(
-                os.path.join(logger_dir, f'{host}-ansible.log'),
-                maxBytes=self.max_bytes,
-                backupCount=self.backup_count
+        if host in self.loggers:
+            return self.loggers[host]
+
+        if self.aggregate_log:
+            # Every host shares one file, and so one handler
+            if self.aggregate_logger is None:
+                self.aggregate_logger = self._create_logger(
+                    'babelfish_log',
+                    os.path.join(self.log_folder, AGGREGATE_LOG_FILE)
+                )
+            logger = self.aggregate_logger
+        else:
+            logger_dir = os.path.join(self.log_folder, host)
+            os.makedirs(logger_dir, exist_ok=True)
+            logger = self._create_logger(
+                'babelfish_log_%s' % host,
+                os.path.join(logger_dir, f'{host}-ansible.log')
             )
+        # Keep the bound log method alongside the logger for the per-event path
+        self.loggers[host] = (logger, logger.log)
+        return self.loggers[host]
+
+
+    def _create_logger(self, name, filename):
+        # Without rotation there's nothing the logging stack adds
+        if not self.max_bytes:
+            return DirectFileLogger(filename, buffer_size=self.write_buffer_size)
+
+        logger = logging.getLogger(name)
+        # getLogger() hands back the same logger to every instance of the
+        # plugin, only keep its handler if it still writes where we're told
+        for handler in list(logger.handlers):
+            target = getattr(handler, 'target', None)
+            if not isinstance(target, BatchedRotatingFileHandler):
+                continue
+            if target.baseFilename == os.path.abspath(filename) \
+                    and target.maxBytes == self.max_bytes \
+                    and target.backupCount == self.backup_count \
+                    and target.buffer_size == self.write_buffer_size:
+                return logger
+            logger.removeHandler(handler)
+            handler.close()
+            target.close()
+
+        logger.setLevel(INFO)
+        logger.propagate = False
+        file_handler = BatchedRotatingFileHandler(
+            filename,
+            buffer_size=self.write_buffer_size,
+            maxBytes=self.max_bytes,
+            backupCount=self.backup_count,
+            delay=True
         )
-        self.loggers[host] = logger
+        file_handler.setLevel(INFO)
+        handler = MemoryHandler(
+            MEMORY_CAPACITY,
+            flushLevel=ERROR,
+            target=file_handler,
+            flushOnClose=True
+        )
+        handler.setLevel(INFO)
+        logger.addHandler(handler)
         return logger
 
 
-    def _format_output(self, output, stringify=True):
-        # If output is a dict
-        if type(output) == dict:
-            results = output.pop('results', None)
-            filtered_output = self.filter_dict_keys(output, self.whitelist_keys)
-            try:
-                if results:
-                    filtered_output['results'] = [
-                        self._format_output(item, False)
-                        for item
-                        in results
-                    ]
-                return json.dumps(filtered_output, indent=2, sort_keys=True) if stringify else filtered_output
-            except:
-                pass
-        # If output is a list of dicts
-        if type(output) == list and type(output[0]) == dict:
-            # This gets a little complicated because it potentially means
-            # nested results, usually because of with_items.
-            real_output = list()
-            for index, item in enumerate(output):
-                real_output.append(self._format_output(item, False))
-            return json.dumps(real_output, indent=2, sort_keys=True) if stringify else real_output
+    def _format_mapping(self, output):
+        """
+        Serialize a mapping that holds no nested results, filtered by the
+        key whitelist if one is set.
+        """
+        try:
+            return encode_payload(self.filter_dict_keys(output, self.whitelist_keys)
+                                  if self.whitelist_keys
+                                  else output)
+        except Exception:
+            return to_text(output)
+
+
+    def _format_output(self, output):
+        # Nested results are restructured off an explicit stack rather than
+        # by recursion. Serializing and key filtering still recurse, results
+        # too deep for them end up in the to_text() fallback.
+        root = [None]
+        pending = [(output, root, 0)]
+        try:
+            while pending:
+                node, parent, index = pending.pop()
+                parent[index] = self._format_node(node, pending)
+            return root[0]
+        except Exception:
+            return to_text(output)
+
+
+    def _format_node(self, output, pending):
+        """
+        Format one level of output. Nested items are left as placeholders and
+        pushed onto pending along with the container and index they fill.
+        """
+        # Scalars need no restructuring
+        if output is None or isinstance(output, (str, int, float, bool)):
+            return str(output)
 
-        # If output is a list of strings
-        if type(output) == list and type(output[0]) != dict:
+        # If output is a dict
+        if isinstance(output, Mapping):
+            results = output.get('results', None)
+            if results is not None:
+                # Leave the caller's result untouched
+                output = dict(output)
+                del output['results']
+            filtered_output = self.filter_dict_keys(output, self.whitelist_keys) \
+                if self.whitelist_keys \
+                else output
+            if results:
+                if filtered_output is None:
+                    filtered_output = {}
+                results = list(results)
+                filtered_output['results'] = [None] * len(results)
+                for index, item in enumerate(results):
+                    pending.append((item, filtered_output['results'], index))
+            return filtered_output
+
+        if isinstance(output, list):
+            if not output:
+                return "[]"
+
+            # If output is a list of dicts
+            if isinstance(output[0], Mapping):
+                # This gets a little complicated because it potentially means
+                # nested results, usually because of with_items.
+                real_output = [None] * len(output)
+                for index, item in enumerate(output):
+                    pending.append((item, real_output, index))
+                return real_output
+
+            # If output is a list of strings
             # Strip newline characters
             real_output = list()
+            total = 0
             for item in output:
-                if "\n" in item:
-                    for string in item.split("\n"):
-                        real_output.append(string)
-                else:
-                    real_output.append(item)
+                parts = item.split("\n") if "\n" in item else (item,)
+                real_output.extend(parts)
+                total += sum(map(len, parts))
 
             # Reformat lists with line breaks only if the total length is
             # >75 chars
-            if len("".join(real_output)) > 75:
+            if total > 75:
                 return "\n" + "\n".join(real_output)
             else:
                 return " ".join(real_output)
@@ -277,7 +609,14 @@ class CallbackModule(CallbackBase):
 
 
     def log(self, result, category, log_level):
+        host_name = result._host.get_name()
+        logger, emit = self.loggers.get(host_name) or self._get_logger(host_name)
+        if not logger.isEnabledFor(log_level):
+            return
+
         data = result._result
+        invocation = None
+        structured = False
         if isinstance(data, MutableMapping) or isinstance(data, dict):
             if self.respect_no_log and 'censored' in data:
                 return
@@ -286,46 +625,65 @@ class CallbackModule(CallbackBase):
                 # avoid logging extraneous data
                 data = 'omitted'
             else:
-                data = data.copy()
-                invocation = data.pop('invocation', {})
-                invocation = invocation.get('module_args', None)
+                if 'invocation' in data:
+                    data = dict(data)
+                    invocation = (data.pop('invocation') or {}).get('module_args', None)
                 data = self._format_output(data)
-                if invocation is not None:
-                    invocation = self._format_output(invocation) \
+                structured = not isinstance(data, str)
+                if invocation:
+                    invocation = self._format_mapping(invocation) \
                         if self.format_invocation \
-                        else json.dumps(invocation)
-                    data = invocation + " => %s " % data
+                        else encode_payload(invocation, COMPACT_JSON_ENCODER)
 
-        now = time.strftime(self.time_format, time.localtime())
+        # Only re-render the timestamp when the wall-clock second changes
+        sec = int(time.time())
+        if sec != self._ts_cached_sec:
+            self._ts_cached_str = time.strftime(self.time_format, time.localtime(sec))
+            self._ts_cached_sec = sec
+        now = self._ts_cached_str
 
-        msg = self.msg_format % dict(
+        fields = dict(
             now=now,
+            host=host_name,
             playbook=self.playbook,
             task_name=result._task.name,
             task_action=result._task.action,
             category=category,
-            data=data,
         )
-        host_name = result._host.get_name()
-        logger = self.loggers[host_name] if host_name in self.loggers else self._get_logger(host_name)
 
-        logger.log(log_level, msg)
+        if structured and isinstance(logger, DirectFileLogger):
+            # Split the record around the payload so it can be encoded
+            # straight into the file's write batch
+            head, marker, tail = self._msg_builder(data=PAYLOAD_MARKER, **fields) \
+                .partition(PAYLOAD_MARKER)
+            if marker and PAYLOAD_MARKER not in tail:
+                if invocation:
+                    head += invocation + " => "
+                    tail = " " + tail
+                logger.log_payload(log_level, head, data, tail)
+                return
+
+        if structured:
+            data = encode_payload(data)
+        if invocation:
+            data = invocation + " => %s " % data
+        emit(log_level, self._msg_builder(data=data, **fields))
 
 
     def filter_dict_keys(self, node, keys=None):
         if not keys:
             return node
-        if not isinstance(keys, list) and isinstance(keys, str):
-            keys = [keys]
-        else:
-            return None
+        if isinstance(keys, str):
+            keys = frozenset((keys,))
+        elif not isinstance(keys, (set, frozenset)):
+            keys = frozenset(keys)
 
-        if isinstance(node, dict):
+        if isinstance(node, Mapping):
             return_value = {}
             for key in node:
                 if key in keys:
                     return_value[key] = copy.deepcopy(node[key])
-                elif isinstance(node[key], list) or isinstance(node[key], dict):
+                elif isinstance(node[key], (list, Mapping)):
                     child = self.filter_dict_keys(node[key], keys)
                     if child:
                         return_value[key] = child
@@ -369,6 +727,24 @@ class CallbackModule(CallbackBase):
         self.playbook = playbook._file_name
 
 
+    def v2_playbook_on_stats(self, stats):
+        self._flush_loggers()
+
+
+    def _flush_loggers(self):
+        # Hand whatever is still sitting in the write buffers to the kernel
+        for logger in set(logger for logger, _ in self.loggers.values()):
+            if isinstance(logger, DirectFileLogger):
+                logger.flush()
+                continue
+            for handler in logger.handlers:
+                # Leave alone anything the plugin didn't attach itself
+                target = getattr(handler, 'target', None)
+                if isinstance(target, BatchedRotatingFileHandler):
+                    handler.flush()
+                    target.flush()
+
+
     def v2_playbook_on_import_for_host(self, result, imported_file):
         self.log(result, 'IMPORTED', INFO)
 
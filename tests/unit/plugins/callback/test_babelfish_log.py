@@ -0,0 +1,150 @@
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+import logging
+from logging import ERROR, INFO
+
+import pytest
+
+from ansible_collections.constructorfleet.vogon.plugins.callback.babelfish_log import (
+    DEFAULT_MSG_FORMAT,
+    AGGREGATE_MSG_PREFIX,
+    BatchedRotatingFileHandler,
+    DirectFileLogger,
+    compile_msg_format,
+)
+
+FIELDS = dict(
+    now='Jan 01 2024 00:00:00',
+    host='web01',
+    playbook='site.yml',
+    task_name='Install packages',
+    task_action='package',
+    category='OK',
+    data='{\n  "changed": false\n}',
+)
+
+
+@pytest.mark.parametrize('msg_format', [
+    DEFAULT_MSG_FORMAT,
+    AGGREGATE_MSG_PREFIX + DEFAULT_MSG_FORMAT,
+    '',
+    'no fields at all',
+    '%(data)s',
+    '100%% - %(host)s - %%(data)s %%',
+    '%(host)s %(data)s %(host)s %(data)s',
+    '[%(now)-25s] %(data)s',
+    '%(category)5s|%(data)s',
+])
+def test_compile_msg_format_matches_percent_operator(msg_format):
+    assert compile_msg_format(msg_format)(**FIELDS) == msg_format % FIELDS
+
+
+def test_compile_msg_format_converts_fields_with_str():
+    fields = dict(FIELDS, playbook=None, data=42)
+    msg_format = '%(playbook)s %(data)s'
+
+    assert compile_msg_format(msg_format)(**fields) == 'None 42'
+
+
+def test_compile_msg_format_unknown_field_raises_like_percent_operator():
+    with pytest.raises(KeyError):
+        compile_msg_format('%(missing)s')(**FIELDS)
+
+
+def test_compile_msg_format_generates_code_for_plain_fields():
+    assert compile_msg_format(DEFAULT_MSG_FORMAT).__name__ == 'build'
+    assert compile_msg_format('[%(now)-25s]').__name__ == 'fallback'
+
+
+def read(path):
+    return path.read_bytes().decode('utf-8') if path.exists() else ''
+
+
+def test_direct_logger_batches_info_records(tmp_path):
+    path = tmp_path / 'host.log'
+    logger = DirectFileLogger(str(path), buffer_size=1024)
+
+    logger.log(INFO, 'first')
+
+    assert read(path) == ''
+    logger.close()
+    assert read(path) == 'first\n'
+
+
+def test_direct_logger_flushes_on_error(tmp_path):
+    path = tmp_path / 'host.log'
+    logger = DirectFileLogger(str(path), buffer_size=1024)
+
+    logger.log(INFO, 'first')
+    logger.log(ERROR, 'failed')
+
+    assert read(path) == 'first\nfailed\n'
+    logger.close()
+
+
+def test_direct_logger_flushes_at_buffer_size(tmp_path):
+    path = tmp_path / 'host.log'
+    logger = DirectFileLogger(str(path), buffer_size=10)
+
+    logger.log(INFO, 'abcd')
+    assert read(path) == ''
+    logger.log(INFO, 'efgh')
+
+    assert read(path) == 'abcd\nefgh\n'
+    logger.close()
+
+
+def test_direct_logger_ignores_records_below_info(tmp_path):
+    path = tmp_path / 'host.log'
+    logger = DirectFileLogger(str(path), buffer_size=0)
+
+    logger.log(logging.DEBUG, 'hidden')
+    logger.close()
+
+    assert read(path) == ''
+
+
+def test_direct_logger_streams_payload(tmp_path):
+    path = tmp_path / 'host.log'
+    logger = DirectFileLogger(str(path))
+
+    logger.log_payload(INFO, 'head ', {'b': [1, 2], 'a': 'x'}, ' tail')
+    logger.close()
+
+    assert read(path) == 'head {\n  "a": "x",\n  "b": [\n    1,\n    2\n  ]\n} tail\n'
+
+
+def test_direct_logger_discards_partial_payload(tmp_path):
+    path = tmp_path / 'host.log'
+    logger = DirectFileLogger(str(path))
+    circular = {'a': 1}
+    circular['self'] = circular
+
+    logger.log(INFO, 'before')
+    logger.log_payload(INFO, 'head ', {'value': circular}, ' tail')
+    logger.close()
+
+    assert read(path) == "before\nhead {'value': {'a': 1, 'self': {...}}} tail\n"
+
+
+def test_rotating_handler_rolls_over_at_max_bytes(tmp_path):
+    path = tmp_path / 'host.log'
+    handler = BatchedRotatingFileHandler(str(path), maxBytes=100, backupCount=3,
+                                         delay=True, encoding='utf-8')
+    logger = logging.getLogger('test_babelfish_log_rotation')
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        for index in range(20):
+            # Multi-byte characters, maxBytes counts bytes
+            logger.warning(u'\u00e9\u20ac record %02d', index)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+    files = sorted(tmp_path.iterdir())
+    assert [f.name for f in files] == ['host.log', 'host.log.1', 'host.log.2', 'host.log.3']
+    assert all(0 < f.stat().st_size <= 100 for f in files)
+    assert read(path).splitlines()[-1] == u'\u00e9\u20ac record 19'